@@ -3,6 +3,7 @@ import asyncio
 from abc import abstractmethod
 import aiobotocore
 import logging
+import random
 from async_timeout import timeout
 from asyncio import CancelledError
 from botocore.exceptions import ClientError
@@ -13,8 +14,68 @@ from . import exceptions
 
 log = logging.getLogger(__name__)
 
+_SESSION = None
+
+
+def _get_session():
+    # One session per process so botocore's loaded service models and credential
+    # resolution are reused on every (re)connect instead of rebuilt each time
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = aiobotocore.session.AioSession()
+    return _SESSION
+
 
 class Base:
+    # Per instance state lives in slots rather than a __dict__, subclasses declare
+    # their own __slots__ for the attributes they add
+    __slots__ = (
+        "__weakref__",
+        "stream_name",
+        "endpoint_url",
+        "region_name",
+        "client",
+        "_shards",
+        "_shard_id_set",
+        "stream_status",
+        "shards_status",
+        "retry_limit",
+        "expo_backoff",
+        "expo_backoff_limit",
+        "skip_describe_stream",
+        "create_stream",
+        "create_stream_shards",
+        "shard_refresh_timer",
+        "_conn_future",
+        "_shutdown",
+        "_describe_lock",
+        "_reconnect_timeout",
+        "_shards_lock",
+        "_subclass_type",
+        "_refresh_event",
+        "_refresh_task",
+        "_resync_described",
+        "_pool_connections",
+    )
+
+    # connection states of kinesis client
+    RECONNECT = "RECONNECT"
+    ACTIVE = "ACTIVE"
+    WAIT = "WAIT"
+    INITIALIZE = "INITIALIZE"
+    # state of local self.shards when compared to kinesis stream shards
+    SYNCED = "SYNCED"
+    RESYNC = "RESYNC"
+
+    # describe_stream responses shared by all clients in this process
+    # (endpoint_url, region_name, stream_name) => (monotonic timestamp, StreamDescription)
+    _describe_cache = {}  # type: dict
+    # seconds a cached description is considered fresh, depending on its StreamStatus
+    describe_cache_ttl_active = 30
+    describe_cache_ttl = 1
+    # minimum size of the http connection pool of each kinesis client
+    max_pool_connections = 10
+
     def __init__(
             self,
             stream_name,
@@ -35,6 +96,7 @@ class Base:
         self.region_name = region_name
 
         self.client = None
+        self._pool_connections = None
         self.shards = []
 
         self.stream_status = None
@@ -43,27 +105,42 @@ class Base:
         self.expo_backoff = expo_backoff
         self.expo_backoff_limit = expo_backoff_limit
 
-        # connection states of kinesis client
-        self.RECONNECT = "RECONNECT"
-        self.ACTIVE = "ACTIVE"
-        self.WAIT = "WAIT"
-        self.INITIALIZE = "INITIALIZE"
-        # state of local self.shards when compared to kinesis stream shards
-        self.SYNCED = "SYNCED"
-        self.RESYNC = "RESYNC"
-
         self.stream_status = self.INITIALIZE
         self.shards_status = self.WAIT
         # Short Lived producer might want to skip describing stream on startup
         self.skip_describe_stream = skip_describe_stream
-        self._conn_lock = asyncio.Lock()
+        self._conn_future = None
+        # set once the client is closing for good, aborts any reconnect backoff in progress
+        self._shutdown = asyncio.Event()
+        self._describe_lock = asyncio.Lock()
         self._reconnect_timeout = time.monotonic()
         self.create_stream = create_stream
         self.create_stream_shards = create_stream_shards
 
         self._shards_lock = asyncio.Lock()
-        self.shard_refresh_monotonic = time.monotonic()
         self.shard_refresh_timer = shard_refresh_timer
+        # set by _refresh_loop() every shard_refresh_timer seconds, checked by sync_shards()
+        self._refresh_event = asyncio.Event()
+        self._refresh_task = None
+        # whether the current refresh window already forced a describe_stream
+        self._resync_described = False
+        # used for log messages only
+        self._subclass_type = type(self).__name__
+
+    @property
+    def shards(self):
+        return self._shards
+
+    @shards.setter
+    def shards(self, shards):
+        self._shards = shards
+        self._ingest_shards(shards)
+
+    def _ingest_shards(self, shards):
+        # Keep the shard ids next to the describe_stream shard dicts so shard id lookups
+        # and diffs do not have to walk the (annotated) dicts.
+        # self.shards stays the source of truth, the consumer keeps per shard state on it
+        self._shard_id_set = frozenset(shard["ShardId"] for shard in shards)
 
     async def __aenter__(self):
 
@@ -88,35 +165,103 @@ class Base:
         await self.client.__aexit__(exc_type, exc, tb)
 
     async def get_client(self):
-        session = aiobotocore.session.AioSession()
+        # release the previous client's connection pool before replacing it, otherwise
+        # sockets pile up in CLOSE_WAIT over repeated reconnects
+        await self._close_client()
+
+        session = _get_session()
 
         # Note: max_attempts = 0
         # Boto RetryHandler only handles these errors:
         #  GENERAL_CONNECTION_ERROR => ConnectionError, ConnectionClosedError, ReadTimeoutError, EndpointConnectionError
         # Still have to handle ClientError anyway~
 
+        self._pool_connections = self._get_pool_connections()
+
+        config = dict(
+            connect_timeout=5,
+            read_timeout=90,
+            retries={"max_attempts": 0},
+            max_pool_connections=self._pool_connections,
+        )
+        # tcp_keepalive is only known to newer botocore releases
+        if "tcp_keepalive" in Config.OPTION_DEFAULTS:
+            config["tcp_keepalive"] = True
+
         self.client = await session.create_client(
             "kinesis",
             endpoint_url=self.endpoint_url,
             region_name=self.region_name,
-            config=Config(
-                connect_timeout=5, read_timeout=90, retries={"max_attempts": 0}
-            ),
+            config=Config(**config),
         ).__aenter__()
 
-    async def get_stream_description(self):
+    def _get_pool_connections(self):
+        # Consumers run a get_records() per shard concurrently, a pool smaller than the
+        # shard count would serialize them. Size off the known shards, else the ones to create
+        shard_count = max(
+            len(self._open_shard_ids(self.shards)), self.create_stream_shards
+        )
+        return max(self.max_pool_connections, shard_count * 2)
+
+    def _describe_cache_key(self):
+        return self.endpoint_url, self.region_name, self.stream_name
 
-        try:
-            return (await self.client.describe_stream(StreamName=self.stream_name))[
-                "StreamDescription"
-            ]
-        except ClientError as err:
-            code = err.response["Error"]["Code"]
-            if code == "ResourceNotFoundException":
-                raise exceptions.StreamDoesNotExist(
-                    "Stream '{}' does not exist".format(self.stream_name)
-                ) from None
-            raise
+    @staticmethod
+    def _copy_stream_description(description):
+        # callers (ie consumer) add keys to the shard dicts, never hand out the cached ones.
+        # Nothing mutates the nested ranges so a copy of each shard dict is enough
+        return dict(
+            description, Shards=[dict(shard) for shard in description["Shards"]]
+        )
+
+    def _get_cached_stream_description(self, max_age=None):
+        cached = self._describe_cache.get(self._describe_cache_key())
+        if not cached:
+            return None
+
+        cached_at, description = cached
+        if max_age is None:
+            max_age = (
+                self.describe_cache_ttl_active
+                if description["StreamStatus"] == self.ACTIVE
+                else self.describe_cache_ttl
+            )
+
+        if (time.monotonic() - cached_at) < max_age:
+            return self._copy_stream_description(description)
+
+    async def get_stream_description(self, max_age=None, call_timeout=10):
+        # max_age=None uses the status based ttl, max_age=0 forces a describe_stream call
+        # call_timeout fails fast on a partitioned network, None defers to the botocore read_timeout
+
+        description = self._get_cached_stream_description(max_age)
+        if description is not None:
+            return description
+
+        async with self._describe_lock:
+            # another coroutine may have refreshed the cache while we waited
+            description = self._get_cached_stream_description(max_age)
+            if description is not None:
+                return description
+
+            try:
+                async with timeout(call_timeout):
+                    description = (
+                        await self.client.describe_stream(StreamName=self.stream_name)
+                    )["StreamDescription"]
+            except ClientError as err:
+                code = err.response["Error"]["Code"]
+                if code == "ResourceNotFoundException":
+                    raise exceptions.StreamDoesNotExist(
+                        "Stream '{}' does not exist".format(self.stream_name)
+                    ) from None
+                raise
+
+            self._describe_cache[self._describe_cache_key()] = (
+                time.monotonic(),
+                description,
+            )
+            return self._copy_stream_description(description)
 
     async def start(self):
 
@@ -125,6 +270,7 @@ class Base:
         if self.create_stream:
             await self._create_stream()
             self.create_stream = False
+            self._describe_cache.pop(self._describe_cache_key(), None)
 
         if self.skip_describe_stream:
             log.debug(
@@ -137,8 +283,17 @@ class Base:
 
         async with timeout(60) as cm:
             try:
+                # back off (with jitter) while the stream settles so a fleet of cold
+                # starting clients does not hammer the DescribeStream limit
+                poll_delay = 0.25
+                last_status = None
+                stream_status = None
+                # a reconnect must really talk to kinesis to prove the new client works
+                max_age = 0 if self.stream_status == self.RECONNECT else None
                 while True:
-                    stream_info = await self.get_stream_description()
+                    stream_info = await self.get_stream_description(
+                        max_age=max_age, call_timeout=None
+                    )
                     stream_status = stream_info["StreamStatus"]
 
                     if stream_status == self.ACTIVE:
@@ -147,91 +302,185 @@ class Base:
                         break
 
                     if stream_status in ["CREATING", "UPDATING"]:
-                        await asyncio.sleep(0.25)
+                        if stream_status != last_status:
+                            poll_delay = 0.25
+                            last_status = stream_status
+                        await asyncio.sleep(random.uniform(0, poll_delay))
+                        poll_delay = min(poll_delay * 2, 5.0)
 
                     else:
                         raise exceptions.StreamStatusInvalid(
                             "Stream '{}' is {}".format(self.stream_name, stream_status)
                         )
             except CancelledError:
-                pass
+                # only our own timeout is handled here, an outer cancel/timeout must propagate
+                if not cm.expired:
+                    raise
 
             else:
                 self.shards = stream_info["Shards"]
 
         if cm.expired:
+            # describe_stream runs without a timeout of its own here, it may never have answered
+            if stream_status is None:
+                raise exceptions.StreamStatusInvalid(
+                    "Stream '{}' could not be described in time".format(self.stream_name)
+                )
             raise exceptions.StreamStatusInvalid(
                 "Stream '{}' is still {}".format(self.stream_name, stream_status)
             )
 
+        # the shard count is only known now, recreate the client if its pool is too small
+        pool_connections = self._get_pool_connections()
+        if pool_connections > self._pool_connections:
+            log.debug(
+                "Recreating client with a pool of %s connections", pool_connections
+            )
+            await self.get_client()
+
+        # start() also runs on every reconnect, keep a single refresh loop
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        # Flag a shard resync every shard_refresh_timer seconds so the producer/consumer loops
+        # only test an event instead of comparing clocks on every pass. Ends once closed
+        while not self._shutdown.is_set():
+            try:
+                await asyncio.wait_for(
+                    self._shutdown.wait(), timeout=self.shard_refresh_timer
+                )
+            except asyncio.TimeoutError:
+                self._refresh_event.set()
+
     async def close(self):
+        # Subclasses must call self._set_shutdown() so a pending reconnect sleep is cut short
         raise NotImplementedError
 
-    async def get_conn(self):
+    async def _close_client(self):
+        # Only releases the kinesis client, _get_reconn_helper uses this between attempts
+        # since close() shuts the producer/consumer down for good
+        if self.client:
+            await self.client.close()
 
-        async with self._conn_lock:
+    def _set_shutdown(self):
+        # closing for good, abort any reconnect backoff and stop the shard refresh loop
+        self._shutdown.set()
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
 
+    async def get_conn(self):
+
+        if log.isEnabledFor(logging.DEBUG):
             log.debug(
                 f"Get Connection (stream name: {self.stream_name}), stream status: {self.stream_status})"
             )
 
-            if self.stream_status == self.INITIALIZE:
-                try:
-                    await self.start()
-                    log.info(f"Connection Successfully Initialized")
-                except exceptions.StreamDoesNotExist:
-                    # Do not attempt to reconnect if stream does not exist
-                    log.error(f"Stream does not exist ({self.stream_name})")
-                    raise
-                except Exception as e:
-                    log.warning(f"Connection Failed to Initialize : {e.__class__} {e}")
-                    await self._get_reconn_helper()
-            elif (
-                    self.stream_status == self.ACTIVE
-                    and (time.monotonic() - self._reconnect_timeout) > 120
-            ):
-                # reconnect_timeout is a Lock so a new connection is not created immediately
-                # after a successfully reconnection has been made since self.start() sets self.stream_status = "ACTIVE"
-                # immediately after a successful reconnect.
-                # Based on testing a hardcode 120 seconds backoff is best since, there could be a lot of pending
-                # coroutines reattempting the connection when the client connection it's already healthy.
+        # Single flight: the first caller drives the (re)connect, every other caller awaits
+        # the same future instead of queueing up to run its own attempt afterwards.
+        # shield() so a cancelled caller does not cancel the connect for everyone else.
+        if self._conn_future is None or self._conn_future.done():
+            self._conn_future = asyncio.create_task(self._get_conn())
+            # every caller may have been cancelled by the time it fails, retrieve the
+            # exception so asyncio does not log "Task exception was never retrieved"
+            self._conn_future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        await asyncio.shield(self._conn_future)
+
+    async def _get_conn(self):
+
+        if self.stream_status == self.INITIALIZE:
+            try:
+                await self.start()
+                log.info(f"Connection Successfully Initialized")
+            except exceptions.StreamDoesNotExist:
+                # Do not attempt to reconnect if stream does not exist
+                log.error(f"Stream does not exist ({self.stream_name})")
+                raise
+            except Exception as e:
+                log.warning(f"Connection Failed to Initialize : {e.__class__} {e}")
                 await self._get_reconn_helper()
+        elif (
+                self.stream_status == self.ACTIVE
+                and (time.monotonic() - self._reconnect_timeout) > 120
+        ):
+            # reconnect_timeout is a Lock so a new connection is not created immediately
+            # after a successfully reconnection has been made since self.start() sets self.stream_status = "ACTIVE"
+            # immediately after a successful reconnect.
+            # Based on testing a hardcode 120 seconds backoff is best since, there could be a lot of pending
+            # coroutines reattempting the connection when the client connection it's already healthy.
+            await self._get_reconn_helper()
+
+    def _get_reconnect_budget(self):
+        # upper bound in seconds for a whole _get_reconn_helper() run
+        return (self.retry_limit or 20) * self.expo_backoff_limit + 60
 
     async def _get_reconn_helper(self):
         # Logic used to reconnect to connect to kinesis if there is a error
 
         self.stream_status = self.RECONNECT
-        backoff_delay = 5
+        # jitter the first attempt too so a fleet that dropped together does not reconnect together
+        backoff_delay = random.uniform(0, 5)
         conn_attempts = 1
-        await self.close()
-        while True:
-            self._reconnect_timeout = time.monotonic()
-            try:
-                log.warning(
-                    f"Connection Error. Rebuilding connection. Sleeping for {backoff_delay} seconds. Reconnection Attempt: {conn_attempts}"
-                )
-                await asyncio.sleep(backoff_delay)
-                await self.start()
-                log.warning(
-                    f"Connection Reestablished After {conn_attempts} and Sleeping for {backoff_delay}"
-                )
-                break
-            except Exception as e:
-                if isinstance(e, exceptions.StreamDoesNotExist):
-                    raise e
-                log.warning(e)
-                conn_attempts += 1
-                if isinstance(self.retry_limit, int):
-                    if conn_attempts >= (self.retry_limit + 1):
-                        await self.close()
-                        raise ConnectionError(
-                            f"Kinesis client has exceeded {self.retry_limit} connection attempts"
+        await self._close_client()
+        # bound the whole reconnect, retry_limit=None would otherwise retry forever while
+        # every get_conn() caller waits on it
+        overall_budget = self._get_reconnect_budget()
+        try:
+            async with timeout(overall_budget):
+                while True:
+                    self._reconnect_timeout = time.monotonic()
+                    try:
+                        log.warning(
+                            f"Connection Error. Rebuilding connection. Sleeping for {backoff_delay} seconds. Reconnection Attempt: {conn_attempts}"
                         )
-                if self.expo_backoff:
-                    backoff_delay = (conn_attempts ** 2) * self.expo_backoff
-                    if backoff_delay >= self.expo_backoff_limit:
-                        backoff_delay = self.expo_backoff_limit
-                await self.close()
+                        try:
+                            await asyncio.wait_for(
+                                self._shutdown.wait(), timeout=backoff_delay
+                            )
+                        except asyncio.TimeoutError:
+                            pass
+                        else:
+                            raise ConnectionError(
+                                "Kinesis client is closing, reconnect aborted"
+                            )
+                        await self.start()
+                        if self.stream_status != self.ACTIVE:
+                            raise ConnectionError(
+                                f"Stream '{self.stream_name}' is not active after reconnecting"
+                            )
+                        log.warning(
+                            f"Connection Reestablished After {conn_attempts} and Sleeping for {backoff_delay}"
+                        )
+                        break
+                    except CancelledError:
+                        # let the overall timeout below fire
+                        raise
+                    except Exception as e:
+                        # do not retry when closing or when the stream does not exist
+                        if isinstance(e, exceptions.StreamDoesNotExist) or self._shutdown.is_set():
+                            raise e
+                        log.warning(e)
+                        conn_attempts += 1
+                        if isinstance(self.retry_limit, int):
+                            if conn_attempts >= (self.retry_limit + 1):
+                                await self._close_client()
+                                raise ConnectionError(
+                                    f"Kinesis client has exceeded {self.retry_limit} connection attempts"
+                                )
+                        if self.expo_backoff:
+                            # "full jitter": sleep a random slice of the capped exponential window
+                            capped = min(
+                                (conn_attempts ** 2) * self.expo_backoff, self.expo_backoff_limit
+                            )
+                            backoff_delay = random.uniform(0, capped)
+                        await self._close_client()
+        except asyncio.TimeoutError:
+            await self._close_client()
+            raise ConnectionError(
+                f"Kinesis reconnect exceeded {overall_budget}s"
+            ) from None
 
     async def _create_stream(self, ignore_exists=True):
 
@@ -263,56 +512,102 @@ class Base:
             else:
                 raise
 
+    def _end_refresh_window(self):
+        self._refresh_event.clear()
+        self._resync_described = False
+
     def set_shard_sync_state(self):
-        subclass_type = type(self).__name__
+        # caller holds self._shards_lock
         self.shards_status = self.SYNCED
-        self.shard_refresh_monotonic = time.monotonic()
-        self._shards_lock.release()
-        log.info("{}: Shard count now at {}".format(subclass_type, self.shards))
+        self._end_refresh_window()
+        log.info("%s: Shard count now at %s", self._subclass_type, self.shards)
+
+    @abstractmethod
+    async def _ingest_initial_shards(self, shards):
+        # First sync after (re)connecting, nothing is held locally to diff against
+        pass
 
     @abstractmethod
-    async def _spilt_shards(self, shards):
-        # Handles Spilt Shard events
+    async def _split_shards(self, shards, added_ids, removed_ids):
+        # Handles Split Shard events, set up the open shards in added_ids
         # https://brandur.org/kinesis-by-example
         pass
 
     @abstractmethod
-    async def _merge_shards(self, shards):
-        # Handles Merge Shard events
+    async def _merge_shards(self, shards, added_ids, removed_ids):
+        # Handles Merge Shard events, drop the local shards in removed_ids
         # https://brandur.org/kinesis-by-example
         pass
 
-    async def sync_shards(self):
+    @staticmethod
+    def _open_shard_ids(shards):
+        return {
+            shard["ShardId"]
+            for shard in shards
+            if not shard["SequenceNumberRange"].get("EndingSequenceNumber")
+        }
+
+    def _diff_shards(self, shards):
+        # Compare the open shards on the stream to the ones held locally.
+        # Closed (parent) shards stay listed by kinesis until they expire so only
+        # open ones are used, otherwise every resync would see them as new
+        open_ids = self._open_shard_ids(shards)
+        return open_ids - self._shard_id_set, self._shard_id_set - open_ids
 
-        subclass_type = type(self).__name__
+    async def sync_shards(self):
 
         if self.shards_status == self.INITIALIZE:
-            stream_info = await self.get_stream_description()
-            await self._shards_lock.acquire()
-            await self._spilt_shards(stream_info['Shards'])
-            self.set_shard_sync_state()
+            stream_info = await self.get_stream_description(call_timeout=10)
+            async with self._shards_lock:
+                try:
+                    await self._ingest_initial_shards(stream_info['Shards'])
+                finally:
+                    self.set_shard_sync_state()
 
         # check if it's time for a RESYNC
-        elif (time.monotonic() - self.shard_refresh_monotonic) > self.shard_refresh_timer \
-                and self.shards_status == self.SYNCED:
+        elif self._refresh_event.is_set() and self.shards_status == self.SYNCED:
 
-            stream_info = await self.get_stream_description()
-            if stream_info["StreamStatus"] == 'UPDATING' or stream_info["StreamStatus"] == 'CREATING':
-                pass
+            # another coroutine is already resyncing, do not queue up behind it for a second describe
+            if self._shards_lock.locked():
+                return
+
+            async with self._shards_lock:
+
+                # re-check with the lock held, a resync may have completed since the check above
+                if not (self._refresh_event.is_set() and self.shards_status == self.SYNCED):
+                    return
+
+                # only the first describe of a refresh window bypasses the cache, retries while
+                # the stream is UPDATING/CREATING are rate limited by the status based ttl
+                max_age = None if self._resync_described else 0
+                self._resync_described = True
+                stream_info = await self.get_stream_description(
+                    max_age=max_age, call_timeout=10
+                )
+
+                if stream_info["StreamStatus"] == 'UPDATING' or stream_info["StreamStatus"] == 'CREATING':
+                    return
 
-            else:
-                await self._shards_lock.acquire()
-                self.shards_status = self.RESYNC
                 stream_shards = stream_info['Shards']
-                if len(stream_info['Shards']) == len(self.shards):
-                    log.debug(
-                        "{}: Stream {} has all shards ids in sync with kinesis".format(
-                            subclass_type, self.stream_name
-                        )
-                    )
-                elif len(stream_info['Shards']) > len(self.shards):
-                    await self._spilt_shards(stream_shards)
+                added_ids, removed_ids = self._diff_shards(stream_shards)
+                if added_ids or removed_ids:
+                    self.shards_status = self.RESYNC
+                    try:
+                        # merge first so shards it frees up count towards what split can take
+                        if removed_ids:
+                            await self._merge_shards(stream_shards, added_ids, removed_ids)
+                        if added_ids:
+                            await self._split_shards(stream_shards, added_ids, removed_ids)
+                    finally:
+                        # on error the next refresh window diffs again
+                        self.set_shard_sync_state()
+                    return
+
+                # nothing to mutate
+                self._end_refresh_window()
 
-                elif len(stream_info['Shards']) < len(self.shards):
-                    await self._merge_shards(stream_shards)
-                self.set_shard_sync_state()
+            log.debug(
+                "%s: Stream %s has all shards ids in sync with kinesis",
+                self._subclass_type,
+                self.stream_name,
+            )
@@ -15,6 +15,8 @@ log = logging.getLogger(__name__)
 
 
 class ShardStats:
+    __slots__ = ("_throttled", "_success")
+
     def __init__(self):
         self._throttled = 0
         self._success = 0
@@ -30,6 +32,19 @@ class ShardStats:
 
 
 class Consumer(Base):
+    __slots__ = (
+        "queue",
+        "sleep_time_no_records",
+        "max_shard_consumers",
+        "record_limit",
+        "is_fetching",
+        "checkpointer",
+        "processor",
+        "iterator_type",
+        "fetch_task",
+        "shard_fetch_rate",
+    )
+
     def __init__(
             self,
             stream_name,
@@ -90,17 +105,19 @@ class Consumer(Base):
 
     async def close(self):
         log.debug("Closing Connection..")
-        if not self.stream_status == self.RECONNECT:
+        self._set_shutdown()
 
+        # a reconnect in progress has no working client to finish the fetches with
+        if not self.stream_status == self.RECONNECT:
             await self.flush()
 
-            if self.fetch_task:
-                self.fetch_task.cancel()
-                self.fetch_task = None
+        if self.fetch_task:
+            self.fetch_task.cancel()
+            self.fetch_task = None
 
-            if self.checkpointer:
-                await self.checkpointer.close()
-        await self.client.close()
+        if self.checkpointer:
+            await self.checkpointer.close()
+        await self._close_client()
 
     async def flush(self):
 
@@ -346,19 +363,16 @@ class Consumer(Base):
 
             shard["fetch"] = None
 
-    async def _spilt_shards(self, shards):
+    async def _allocate_shards(self, shards, shard_ids, held_count=0):
+        # Allocate and set up the shards in shard_ids, returns the ones now owned by this consumer
         new_shards = []
         for shard in shards:
 
-            if type(self.max_shard_consumers) == int and self.max_shard_consumers <= len(new_shards):
+            if shard["ShardId"] not in shard_ids:
                 continue
 
-            if shard["SequenceNumberRange"].get("EndingSequenceNumber"):
-                existing_shard = any(x for x in self.shards if x['ShardId'] == shard["ShardId"])
-                if existing_shard:
-                    ## TODO: change check point after reshard
-                    ## NotImplementedError: test-b64c5c96/100942 checkpointed on shardId-000000000000 but ref is different test-b64c5c96/100942
-                    await self.checkpointer.deallocate(shard["ShardId"])
+            if type(self.max_shard_consumers) == int and \
+                    self.max_shard_consumers <= held_count + len(new_shards):
                 continue
 
             success, checkpoint = await self.checkpointer.allocate(shard["ShardId"])
@@ -374,22 +388,40 @@ class Consumer(Base):
                 )
             new_shards.append(shard)
 
-        self.shards = new_shards
+        return new_shards
+
+    async def _ingest_initial_shards(self, shards):
+        self.shards = await self._allocate_shards(shards, self._open_shard_ids(shards))
+        log.info(
+            " Stream {} has shards ids {}".format(
+                self.stream_name, ", ".join([x['ShardId'] for x in self.shards])
+            )
+        )
+
+    async def _split_shards(self, shards, added_ids, removed_ids):
+        # keep the shards already set up (their iterator/fetch state), only allocate new ones
+        existing_shards = [x for x in self.shards if x['ShardId'] not in added_ids]
+        new_shards = await self._allocate_shards(
+            shards, added_ids, held_count=len(existing_shards)
+        )
+
+        self.shards = existing_shards + new_shards
         log.info(
             " Stream {} has added shards ids {}".format(
                 self.stream_name, ", ".join([x['ShardId'] for x in new_shards])
             )
         )
 
-    async def _merge_shards(self, shards):
+    async def _merge_shards(self, shards, added_ids, removed_ids):
         new_shards = []
         old_shards = []
-        for shard in shards:
-            if shard["SequenceNumberRange"].get("EndingSequenceNumber"):
-                existing_shard = any(x for x in self.shards if x['ShardId'] == shard["ShardId"])
-                if existing_shard:
+        for shard in self.shards:
+            if shard["ShardId"] in removed_ids:
+                ## TODO: change check point after reshard
+                ## NotImplementedError: test-b64c5c96/100942 checkpointed on shardId-000000000000 but ref is different test-b64c5c96/100942
+                if self.checkpointer.is_allocated(shard["ShardId"]):
                     await self.checkpointer.deallocate(shard["ShardId"])
-                    old_shards.append(shard)
+                old_shards.append(shard)
                 continue
             new_shards.append(shard)
         self.shards = new_shards
@@ -17,6 +17,25 @@ log = logging.getLogger(__name__)
 
 
 class Producer(Base):
+    __slots__ = (
+        "buffer_time",
+        "processor",
+        "queue",
+        "batch_size",
+        "put_rate_limit_per_shard",
+        "put_rate_throttle",
+        "put_bandwidth_limit_per_shard",
+        "put_bandwidth_throttle",
+        "flush_task",
+        "is_flushing",
+        "after_flush_fun",
+        "throughput_exceeded_count",
+        "overflow",
+        "flush_total_records",
+        "flush_total_size",
+        "flush_max_size",
+    )
+
     def __init__(
             self,
             stream_name,
@@ -120,13 +139,14 @@ class Producer(Base):
 
     async def close(self):
         log.debug(f"Closing Connection.. (stream status:{self.stream_status})")
+        self._set_shutdown()
+        # Cancel Flush Task
+        self.flush_task.cancel()
+        # final flush (probably not required but no harm), not possible while reconnecting
         if not self.stream_status == self.RECONNECT:
-            # Cancel Flush Task
-            self.flush_task.cancel()
-            # final flush (probably not required but no harm)
             await self.flush()
 
-        await self.client.close()
+        await self._close_client()
 
     async def _flush(self):
         while True:
@@ -346,28 +366,29 @@ class Producer(Base):
                 log.critical("Unknown Exception Caught")
                 await self.get_conn()
 
-    async def _spilt_shards(self, shards):
-        new_shards = []
-        for shard in shards:
-            if shard["SequenceNumberRange"].get("EndingSequenceNumber"):
-                continue
-            new_shards.append(shard)
+    async def _ingest_initial_shards(self, shards):
+        open_ids = self._open_shard_ids(shards)
+        self.shards = [x for x in shards if x['ShardId'] in open_ids]
+        log.info(
+            " Stream {} has shards ids {}".format(
+                self.stream_name, ", ".join([x['ShardId'] for x in self.shards])
+            )
+        )
+
+    async def _split_shards(self, shards, added_ids, removed_ids):
+        new_shards = [x for x in shards if x['ShardId'] in added_ids]
 
-        self.shards = new_shards
+        self.shards = [x for x in self.shards if x['ShardId'] not in added_ids] + new_shards
         log.info(
             " Stream {} has added shards ids {}".format(
                 self.stream_name, ", ".join([x['ShardId'] for x in new_shards])
             )
         )
 
-    async def _merge_shards(self, shards):
-        new_shards = []
-        old_shards = []
-        for shard in shards:
-            if shard["SequenceNumberRange"].get("EndingSequenceNumber"):
-                old_shards.append(shard)
-            new_shards.append(shard)
-        self.shards = new_shards
+    async def _merge_shards(self, shards, added_ids, removed_ids):
+        old_shards = [x for x in self.shards if x['ShardId'] in removed_ids]
+
+        self.shards = [x for x in self.shards if x['ShardId'] not in removed_ids]
         log.info(
             " Stream {} has removed stale shards ids {}".format(
                 self.stream_name, ", ".join([x['ShardId'] for x in old_shards])
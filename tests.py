@@ -1,9 +1,11 @@
+import gc
 import os
 import uuid
 import asyncio
 import logging, coloredlogs
 from dotenv import load_dotenv
 from asynctest import TestCase as AsynTestCase, fail_on, mock
+from async_timeout import timeout as real_timeout
 from unittest import skipUnless, TestCase
 from kinesis import Consumer, Producer, MemoryCheckPointer, RedisCheckPointer
 from kinesis.processors import (
@@ -63,6 +65,58 @@ class BaseKinesisTests(AsynTestCase, BaseTests):
         await producer.put(msg)
 
 
+class FakeKinesisClient:
+    """
+    Stands in for the aiobotocore kinesis client (no network)
+    """
+
+    def __init__(self, shards=None, status="ACTIVE", hang=False, delay=0):
+        self.shards = shards if shards is not None else []
+        self.status = status
+        self.hang = hang
+        self.delay = delay
+        self.describe_calls = 0
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def describe_stream(self, StreamName):
+        self.describe_calls += 1
+        if self.hang:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(self.delay)
+        return {
+            "StreamDescription": {"StreamStatus": self.status, "Shards": self.shards}
+        }
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """
+    Stands in for the aiobotocore session, hands out FakeKinesisClients (no network)
+    """
+
+    def __init__(self, shards=None):
+        self.shards = shards
+        self.clients = []
+
+    def create_client(self, service_name, endpoint_url=None, region_name=None, config=None):
+        client = FakeKinesisClient(shards=self.shards)
+        client.config = config
+        self.clients.append(client)
+        return client
+
+
+def make_shard(shard_id, closed=False):
+    sequence_range = {"StartingSequenceNumber": "1"}
+    if closed:
+        sequence_range["EndingSequenceNumber"] = "100"
+    return {"ShardId": shard_id, "SequenceNumberRange": sequence_range}
+
+
 class ProcessorAndAggregatorTests(TestCase, BaseTests):
     """
     Processor and Aggregator Tests
@@ -390,6 +444,11 @@ class CheckpointTests(BaseKinesisTests):
     Checkpoint Tests
     """
 
+    @mock.patch('kinesis.consumer.Consumer.get_stream_description', side_effect=lambda **kwargs: {
+        "StreamStatus": "ACTIVE",
+        "Shards": [{"ShardId": "test-1", "SequenceNumberRange": {}},
+                   {"ShardId": "test-2", "SequenceNumberRange": {}}],
+    })
     @mock.patch('kinesis.consumer.Consumer.get_shard_iterator')
     async def test_memory_checkpoint(self, *args):
         # *args pass through mock
@@ -510,6 +569,352 @@ class CheckpointTests(BaseKinesisTests):
         self.assertTrue(True)
 
 
+class ReconnectTests(BaseKinesisTests):
+    """
+    Reconnect Tests (no network)
+    """
+
+    def setUp(self):
+        self.stream_name = "test_{}".format(str(uuid.uuid4())[0:8])
+
+    @mock.patch("kinesis.base.random.uniform", return_value=0)
+    @mock.patch("kinesis.consumer.Consumer._get_reconnect_budget", return_value=0.2)
+    @mock.patch("kinesis.consumer.Consumer.get_client")
+    async def test_reconnect_budget_expires_during_start(self, *args):
+        # *args pass through mock
+        consumer = Consumer(stream_name=self.stream_name, endpoint_url=ENDPOINT_URL)
+        consumer.client = FakeKinesisClient(hang=True)
+        consumer.stream_status = consumer.ACTIVE
+
+        # start() hangs on describe_stream, the budget must still raise rather than
+        # leaving the client stuck in RECONNECT
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(consumer._get_reconn_helper(), timeout=5)
+
+    @mock.patch("kinesis.base.random.uniform", return_value=3600)
+    async def test_close_aborts_reconnect_backoff(self, *args):
+        # *args pass through mock
+        consumer = Consumer(stream_name=self.stream_name, endpoint_url=ENDPOINT_URL)
+        consumer.client = FakeKinesisClient()
+        consumer.stream_status = consumer.ACTIVE
+
+        reconnect = asyncio.ensure_future(consumer._get_reconn_helper())
+        await asyncio.sleep(0.1)
+        self.assertFalse(reconnect.done())
+
+        # the reconnect itself only closes the client, not the consumer
+        self.assertFalse(consumer._shutdown.is_set())
+
+        await consumer.close()
+
+        # the hour long backoff is cut short
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(reconnect, timeout=5)
+
+    async def test_start_resizes_connection_pool(self):
+        session = FakeSession(shards=[make_shard("shard-{}".format(i)) for i in range(8)])
+        consumer = Consumer(stream_name=self.stream_name, endpoint_url=ENDPOINT_URL)
+
+        with mock.patch("kinesis.base._get_session", return_value=session):
+            await consumer.start()
+        consumer._set_shutdown()
+
+        # the shard count is only known after the first describe, the client is rebuilt
+        # with two connections per shard
+        self.assertEqual(
+            [client.config.max_pool_connections for client in session.clients], [10, 16]
+        )
+        self.assertTrue(session.clients[0].closed)
+        self.assertIs(consumer.client, session.clients[1])
+        self.assertFalse(consumer.client.closed)
+
+    async def test_get_conn_single_flight(self):
+        consumer = Consumer(stream_name=self.stream_name, endpoint_url=ENDPOINT_URL)
+
+        async def start():
+            await asyncio.sleep(0.1)
+            consumer.stream_status = consumer.ACTIVE
+
+        with mock.patch.object(Consumer, "start", side_effect=start) as start_mock:
+            await asyncio.gather(*[consumer.get_conn() for _ in range(5)])
+
+        # every concurrent caller waited on the same connect
+        self.assertEqual(start_mock.call_count, 1)
+        self.assertEqual(consumer.stream_status, consumer.ACTIVE)
+
+    async def test_get_conn_error_after_caller_cancelled(self):
+        consumer = Consumer(stream_name=self.stream_name, endpoint_url=ENDPOINT_URL)
+        unretrieved = []
+        self.loop.set_exception_handler(lambda loop, context: unretrieved.append(context))
+
+        async def start():
+            await asyncio.sleep(0.1)
+            raise exceptions.StreamDoesNotExist("Stream '{}' does not exist".format(self.stream_name))
+
+        with mock.patch.object(Consumer, "start", side_effect=start):
+            caller = asyncio.ensure_future(consumer.get_conn())
+            await asyncio.sleep(0.01)
+            caller.cancel()
+            # the connect task carries on without any caller and fails
+            await asyncio.sleep(0.2)
+
+        self.assertTrue(consumer._conn_future.done())
+        consumer._conn_future = None
+        gc.collect()
+
+        self.assertEqual(unretrieved, [])
+
+
+class DescribeCacheTests(BaseKinesisTests):
+    """
+    Describe Stream Cache and Timeout Tests (no network)
+    """
+
+    def setUp(self):
+        self.stream_name = "test_{}".format(str(uuid.uuid4())[0:8])
+        self.consumer = Consumer(stream_name=self.stream_name, endpoint_url=ENDPOINT_URL)
+        self.consumer.client = FakeKinesisClient(shards=[make_shard("shard-1")])
+
+    async def test_cache_hit(self):
+        await self.consumer.get_stream_description()
+        await self.consumer.get_stream_description()
+
+        self.assertEqual(self.consumer.client.describe_calls, 1)
+
+    async def test_cache_force_refresh(self):
+        await self.consumer.get_stream_description()
+        await self.consumer.get_stream_description(max_age=0)
+
+        self.assertEqual(self.consumer.client.describe_calls, 2)
+
+    async def test_cache_returns_copies(self):
+        description = await self.consumer.get_stream_description()
+        description["Shards"][0]["ShardIterator"] = "test"
+
+        description = await self.consumer.get_stream_description()
+
+        self.assertNotIn("ShardIterator", description["Shards"][0])
+        self.assertEqual(self.consumer.client.describe_calls, 1)
+
+    @mock.patch("kinesis.base.Base.describe_cache_ttl", 0)
+    async def test_cache_ttl_by_status(self):
+        self.consumer.client.status = "UPDATING"
+
+        await self.consumer.get_stream_description()
+        await self.consumer.get_stream_description()
+
+        # non active descriptions use the (patched to 0) short ttl
+        self.assertEqual(self.consumer.client.describe_calls, 2)
+
+        self.consumer.client.status = "ACTIVE"
+
+        await self.consumer.get_stream_description()
+        await self.consumer.get_stream_description()
+
+        self.assertEqual(self.consumer.client.describe_calls, 3)
+
+    async def test_call_timeout(self):
+        self.consumer.client.hang = True
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                self.consumer.get_stream_description(call_timeout=0.1), timeout=5
+            )
+
+    @mock.patch("kinesis.consumer.Consumer.get_client")
+    async def test_start_only_bounded_by_overall_timeout(self, *args):
+        # *args pass through mock
+        self.consumer.client.hang = True
+        delays = []
+
+        def short_timeout(delay):
+            # record then shrink start()'s 60s bound so the test does not wait for it
+            delays.append(delay)
+            return real_timeout(0.2 if delay == 60 else delay)
+
+        with mock.patch("kinesis.base.timeout", side_effect=short_timeout):
+            with self.assertRaises(exceptions.StreamStatusInvalid):
+                await asyncio.wait_for(self.consumer.start(), timeout=5)
+
+        # describe_stream gets no timeout of its own, inside start() only the 60s one applies
+        self.assertEqual(delays, [60, None])
+
+
+class ShardSyncTests(BaseKinesisTests):
+    """
+    Shard Sync Tests (no network)
+    """
+
+    def setUp(self):
+        self.stream_name = "test_{}".format(str(uuid.uuid4())[0:8])
+
+    async def get_consumer(self, shards, **kwargs):
+        consumer = Consumer(
+            stream_name=self.stream_name, endpoint_url=ENDPOINT_URL, **kwargs
+        )
+        consumer.client = FakeKinesisClient(shards=shards)
+        consumer.stream_status = consumer.ACTIVE
+        consumer.shards_status = consumer.INITIALIZE
+        await consumer.sync_shards()
+        return consumer
+
+    async def resync(self, consumer, shards, status="ACTIVE"):
+        consumer.client.shards = shards
+        consumer.client.status = status
+        consumer._refresh_event.set()
+        await consumer.sync_shards()
+
+    @mock.patch("kinesis.consumer.Consumer.get_client")
+    async def test_refresh_loop(self, *args):
+        # *args pass through mock
+        consumer = Consumer(
+            stream_name=self.stream_name, endpoint_url=ENDPOINT_URL, shard_refresh_timer=0.05
+        )
+        consumer.client = FakeKinesisClient(shards=[make_shard("shard-1")])
+        consumer._pool_connections = consumer.max_pool_connections
+
+        await consumer.start()
+        refresh_task = consumer._refresh_task
+        self.assertFalse(consumer._refresh_event.is_set())
+
+        await asyncio.sleep(0.2)
+        self.assertTrue(consumer._refresh_event.is_set())
+
+        # start() runs again on every reconnect, it must keep the same loop
+        consumer.stream_status = consumer.RECONNECT
+        await consumer.start()
+        self.assertIs(consumer._refresh_task, refresh_task)
+
+        consumer._set_shutdown()
+        await asyncio.sleep(0)
+
+        self.assertTrue(refresh_task.done())
+        self.assertIsNone(consumer._refresh_task)
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_initial_shards_skip_closed(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer(
+            [make_shard("shard-1", closed=True), make_shard("shard-2"), make_shard("shard-3")]
+        )
+
+        self.assertEqual([s["ShardId"] for s in consumer.shards], ["shard-2", "shard-3"])
+        self.assertTrue(all(s.get("ShardIterator") for s in consumer.shards))
+        self.assertEqual(consumer.shards_status, consumer.SYNCED)
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_split_keeps_existing_shards(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer([make_shard("shard-1"), make_shard("shard-2")])
+
+        consumer.shards[0]["fetch"] = "in-flight"
+
+        # shard-2 splits into shard-3 and shard-4
+        await self.resync(consumer, [
+            make_shard("shard-1"),
+            make_shard("shard-2", closed=True),
+            make_shard("shard-3"),
+            make_shard("shard-4"),
+        ])
+
+        self.assertEqual(
+            [s["ShardId"] for s in consumer.shards], ["shard-1", "shard-3", "shard-4"]
+        )
+        # the untouched shard keeps its state
+        self.assertEqual(consumer.shards[0]["fetch"], "in-flight")
+        self.assertFalse(consumer.checkpointer.is_allocated("shard-2"))
+        self.assertTrue(consumer.checkpointer.is_allocated("shard-3"))
+
+        # closed parents stay listed by kinesis, they must not be seen as new
+        iterator_calls = consumer.get_shard_iterator.call_count
+        await self.resync(consumer, consumer.client.shards)
+
+        self.assertEqual(consumer.get_shard_iterator.call_count, iterator_calls)
+        self.assertEqual(
+            [s["ShardId"] for s in consumer.shards], ["shard-1", "shard-3", "shard-4"]
+        )
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_merge_then_split_with_max_shard_consumers(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer(
+            [make_shard("shard-1"), make_shard("shard-2")], max_shard_consumers=2
+        )
+
+        # shard-1 and shard-2 merge into shard-3, the merge has to free both slots
+        # before the split handler allocates shard-3
+        await self.resync(consumer, [
+            make_shard("shard-1", closed=True),
+            make_shard("shard-2", closed=True),
+            make_shard("shard-3"),
+        ])
+
+        self.assertEqual([s["ShardId"] for s in consumer.shards], ["shard-3"])
+        self.assertFalse(consumer.checkpointer.is_allocated("shard-1"))
+        self.assertFalse(consumer.checkpointer.is_allocated("shard-2"))
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_max_shard_consumers_counts_held_shards(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer(
+            [make_shard("shard-1"), make_shard("shard-2")], max_shard_consumers=2
+        )
+
+        await self.resync(consumer, [
+            make_shard("shard-1"),
+            make_shard("shard-2"),
+            make_shard("shard-3"),
+        ])
+
+        self.assertEqual([s["ShardId"] for s in consumer.shards], ["shard-1", "shard-2"])
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_resync_single_flight(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer([make_shard("shard-1")])
+        consumer.client.delay = 0.1
+        describe_calls = consumer.client.describe_calls
+
+        consumer._refresh_event.set()
+        await asyncio.gather(*[consumer.sync_shards() for _ in range(5)])
+
+        self.assertEqual(consumer.client.describe_calls, describe_calls + 1)
+        self.assertFalse(consumer._refresh_event.is_set())
+        self.assertFalse(consumer._shards_lock.locked())
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_resync_while_updating_uses_cache(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer([make_shard("shard-1")])
+        describe_calls = consumer.client.describe_calls
+
+        await self.resync(consumer, consumer.client.shards, status="UPDATING")
+        for _ in range(4):
+            await consumer.sync_shards()
+
+        # first describe of the window is forced, the retries hit the status based ttl
+        self.assertEqual(consumer.client.describe_calls, describe_calls + 1)
+        self.assertTrue(consumer._refresh_event.is_set())
+        self.assertFalse(consumer._shards_lock.locked())
+
+    @mock.patch('kinesis.consumer.Consumer.get_shard_iterator', return_value="iterator")
+    async def test_resync_error_releases_lock(self, *args):
+        # *args pass through mock
+        consumer = await self.get_consumer([make_shard("shard-1")])
+
+        with mock.patch.object(Consumer, "_split_shards", side_effect=Exception("boom")):
+            with self.assertRaises(Exception):
+                await self.resync(consumer, [make_shard("shard-1"), make_shard("shard-2")])
+
+        self.assertFalse(consumer._shards_lock.locked())
+        self.assertEqual(consumer.shards_status, consumer.SYNCED)
+
+        # next refresh window picks the new shard up
+        await self.resync(consumer, consumer.client.shards)
+
+        self.assertEqual([s["ShardId"] for s in consumer.shards], ["shard-1", "shard-2"])
+
+
 class KinesisTests(BaseKinesisTests):
     """
     Kinesalite Tests